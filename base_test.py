@@ -2,8 +2,6 @@ import json
 import os
 import random
 from dotenv import load_dotenv
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import roc_auc_score
 import torch
 from tqdm import tqdm
 import wandb
@@ -19,58 +17,19 @@ from utils import (
 )
 from datasets import get_dataloaders
 from methods import compute_mask
+from metrics import compute_basic_mia
 import numpy as np
 
 
-def compute_basic_mia(retain_losses, forget_losses, val_losses, test_losses):
-    train_loss = (
-        torch.cat((retain_losses, val_losses), dim=0).unsqueeze(1).cpu().numpy()
-    )
-    train_target = torch.cat(
-        (torch.ones(retain_losses.size(0)), torch.zeros(val_losses.size(0))), dim=0
-    ).numpy()
-    test_loss = (
-        torch.cat((forget_losses, test_losses), dim=0).unsqueeze(1).cpu().numpy()
-    )
-    test_target = (
-        torch.cat((torch.ones(forget_losses.size(0)), torch.zeros(test_losses.size(0))))
-        .cpu()
-        .numpy()
-    )
-
-    best_auc = 0
-    best_acc = 0
-    for n_est in [20, 50, 100]:
-        for criterion in ["gini", "entropy"]:
-            mia_model = RandomForestClassifier(
-                n_estimators=n_est, criterion=criterion, n_jobs=8, random_state=0
-            )
-            mia_model.fit(train_loss, train_target)
-
-            y_hat = mia_model.predict_proba(test_loss)[:, 1]
-            auc = roc_auc_score(test_target, y_hat) * 100
-            # breakpoint()
-            y_hat = mia_model.predict(forget_losses.unsqueeze(1).cpu().numpy()).mean()
-
-            # breakpoint()
-            acc = (1 - y_hat) * 100
-
-            if acc > best_acc:
-                best_acc = acc
-                best_auc = auc
-    # breakpoint()
-    return best_auc, best_acc
-
-
 def eval_unlearning(model, loaders, names, criterion, DEVICE):
 
     model.eval()
-    tot_acc = 0
     accs = {}
     losses = {}
     for loader, name in zip(loaders, names):
 
-        losses[name] = []
+        tot_acc = torch.zeros((), device=DEVICE)
+        loss_buf = []
         for data in tqdm(loader):
 
             image = data["image"]
@@ -81,17 +40,18 @@ def eval_unlearning(model, loaders, names, criterion, DEVICE):
             output = model(image)
             loss = criterion(output, target)
 
-            losses[name].append(loss.mean().item())
+            loss_buf.append(loss.detach())
 
             acc = compute_topk(target, output, 1)
 
             tot_acc += acc
 
         if len(loader.dataset) == 0:
-            tot_acc = 0
+            accs[name] = 0
         else:
-            tot_acc /= len(loader.dataset)
-        accs[name] = tot_acc
+            accs[name] = (tot_acc / len(loader.dataset)).item()
+        # Per-sample losses as one tensor, a single transfer per loader
+        losses[name] = torch.cat(loss_buf).cpu() if loss_buf else torch.empty(0)
     return accs, losses
 
 
@@ -155,10 +115,10 @@ if __name__ == "__main__":
             mia_acc = 0
         else:
             mia_auc, mia_acc = compute_basic_mia(
-                torch.tensor(losses["retain"]),
-                torch.tensor(losses["forget"]),
-                torch.tensor(losses["val"]),
-                torch.tensor(losses["test"]),
+                losses["retain"],
+                losses["forget"],
+                losses["val"],
+                losses["test"],
             )
 
         for key, value in accs.items():
@@ -235,6 +235,17 @@ def get_dataloaders(
     pin_memory=True,
 ):
 
+    # Keep workers alive between epochs and prefetch batches ahead so
+    # pinned-memory copies can overlap with compute on the GPU
+    loader_kwargs = {
+        "batch_size": batch_s,
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+    }
+    if num_workers > 0:
+        loader_kwargs["persistent_workers"] = True
+        loader_kwargs["prefetch_factor"] = 2
+
     if dataname == "cifar10":
         dataclass = UnlearnCifar10
     elif dataname == "cifar100":
@@ -263,48 +274,12 @@ def get_dataloaders(
     shadow_subset = list(np.random.choice(dataset.TRAIN, len(dataset.FORGET)))
     shadow_set = Subset(dataset, shadow_subset)
 
-    train_l = DataLoader(
-        train_set,
-        batch_size=batch_s,
-        shuffle=True,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-    )
-    val_l = DataLoader(
-        val_set,
-        batch_size=batch_s,
-        shuffle=False,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-    )
-    test_l = DataLoader(
-        test_set,
-        batch_size=batch_s,
-        shuffle=False,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-    )
-    forget_l = DataLoader(
-        forget_set,
-        batch_size=batch_s,
-        shuffle=False,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-    )
-    retain_l = DataLoader(
-        retain_set,
-        batch_size=batch_s,
-        shuffle=False,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-    )
-    shadow_l = DataLoader(
-        shadow_set,
-        batch_size=batch_s,
-        shuffle=False,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-    )
+    train_l = DataLoader(train_set, shuffle=True, **loader_kwargs)
+    val_l = DataLoader(val_set, shuffle=False, **loader_kwargs)
+    test_l = DataLoader(test_set, shuffle=False, **loader_kwargs)
+    forget_l = DataLoader(forget_set, shuffle=False, **loader_kwargs)
+    retain_l = DataLoader(retain_set, shuffle=False, **loader_kwargs)
+    shadow_l = DataLoader(shadow_set, shuffle=False, **loader_kwargs)
 
     return train_l, val_l, test_l, forget_l, retain_l, shadow_l
 
@@ -18,8 +18,12 @@ from utils import (
     get_model,
     set_seed,
     get_avg_std,
+    flatten_optimizer_state,
+    RunConfig,
+    CUDAPrefetcher,
+    split_gpu_transform,
 )
-from metrics import compute_basic_mia, eval_unlearning
+from metrics import compute_basic_mia, eval_unlearning, eval_train_split
 from datasets import get_dataloaders
 
 
@@ -31,30 +35,40 @@ class MockScheduler:
         pass
 
 
-def train(model, loader, method, criterion, optimizer, device, mask=None):
+def train(model, loader, method, criterion, optimizer, device, mask=None, gpu_transform=None):
 
     model.train()
 
-    for data in tqdm(loader):
+    if USE_MASK:
+        # Align parameters and mask tensors once so the per-step multiply
+        # runs as a single multi-tensor kernel instead of ~60 launches
+        masked_params = [p for n, p in model.named_parameters() if n in mask]
+        mask_tensors = [mask[n] for n, p in model.named_parameters() if n in mask]
+
+    for data in tqdm(CUDAPrefetcher(loader, device)):
 
         image = data["image"]
         target = data["label"]
         idx = data["idx"]
 
-        image = image.to(DEVICE, non_blocking=True)
+        image = image.to(
+            DEVICE, non_blocking=True, memory_format=torch.channels_last
+        )
         target = target.to(DEVICE, non_blocking=True)
         idx = idx.to(DEVICE, non_blocking=True)
 
-        loss = method(model, image, target, idx, criterion, loader, device)
+        if gpu_transform is not None:
+            image = gpu_transform(image)
+
+        with torch.autocast("cuda", dtype=torch.bfloat16, enabled=device == "cuda"):
+            loss = method(model, image, target, idx, criterion, loader, device)
         loss.backward()
 
         if USE_MASK:
-            for name, param in model.named_parameters():
-                if name in mask:
-                    param.grad *= mask[name]
+            torch._foreach_mul_([p.grad for p in masked_params], mask_tensors)
 
         optimizer.step()
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
 
 
 if __name__ == "__main__":
@@ -66,19 +80,6 @@ if __name__ == "__main__":
 
     LOAD = args.load
 
-    default = {
-        "checkpoint": "checkpoints/resnet18_cifar10_pretrained_best.pt",
-        "class_to_forget": None,
-        "unlearning_rate": None,
-        "idxs_to_forget": None,
-        "use_mask": True,
-        "mask_thr": 0.5,
-        "lr": 0.1,
-        "epochs": 10,
-        "method": "rl",
-        "tag": None,
-    }
-
     if LOAD == "":
         print("[LOADER] Loading parameters from command line")
         experiments = [args_dict]
@@ -113,7 +114,7 @@ if __name__ == "__main__":
 
         for expidx in range(NEXP):
 
-            settings = {**default, **exp}
+            settings = RunConfig.from_dict(exp).to_dict()
 
             print(f"[EXP {nexp+1} of {len(experiments)}] Running settings: {settings}")
             print(f"[RUN {expidx+1} of {NEXP}]")
@@ -127,7 +128,11 @@ if __name__ == "__main__":
             EPOCHS = settings["epochs"]
             METHOD = settings["method"]
 
-            model, config, transform, opt = load_checkpoint(CHKP)
+            model, config, transform, opt = load_checkpoint(
+                CHKP, disable_mmap=args.disable_mmap
+            )
+            # Normalization runs batched on the GPU, workers only decode+resize
+            transform, gpu_transform = split_gpu_transform(transform)
 
             DSET = config["dataset"]
             MODEL = config["model"]
@@ -145,7 +150,11 @@ if __name__ == "__main__":
                 classes = train_loader.dataset.dataset.classes
                 model, _, _ = get_model(MODEL, len(classes), False)
 
-            model = model.to(DEVICE)
+            model = model.to(DEVICE, memory_format=torch.channels_last)
+            if DEVICE == "cuda":
+                # ResNet-18 on CIFAR batches is launch-overhead bound;
+                # compiling fuses elementwise ops and cuts kernel launches
+                model = torch.compile(model, mode="reduce-overhead")
             optimizer = torch.optim.SGD(model.parameters(), lr=LR)
             criterion = torch.nn.CrossEntropyLoss(reduction="none")
 
@@ -165,6 +174,7 @@ if __name__ == "__main__":
                     unlearn_lr=LR,
                     saliency_threshold=MASK_THR,
                     device=DEVICE,
+                    gpu_transform=gpu_transform,
                 )
 
             # -------------------------------------------------------------
@@ -172,19 +182,26 @@ if __name__ == "__main__":
             print("[MAIN] Evaluating model")
             accs, losses = eval_unlearning(
                 model,
-                [test_loader, forget_loader, retain_loader, val_loader],
-                ["test", "forget", "retain", "val"],
+                [test_loader, val_loader],
+                ["test", "val"],
                 criterion,
                 DEVICE,
+                gpu_transform=gpu_transform,
+            )
+            # Forget/retain metrics come from one pass over the train set
+            split_accs, split_losses = eval_train_split(
+                model, train_loader, criterion, DEVICE, gpu_transform=gpu_transform
             )
+            accs.update(split_accs)
+            losses.update(split_losses)
             accs["forget"] = 1 - accs["forget"]
 
             print("[MAIN] Computing MIA")
             mia_auc, mia_acc = compute_basic_mia(
-                torch.tensor(losses["retain"]),
-                torch.tensor(losses["forget"]),
-                torch.tensor(losses["val"]),
-                torch.tensor(losses["test"]),
+                losses["retain"],
+                losses["forget"],
+                losses["val"],
+                losses["test"],
             )
 
             for key, value in accs.items():
@@ -231,7 +248,16 @@ if __name__ == "__main__":
 
                 print(f"Epoch {epoch}")
 
-                train(model, loader, method, criterion, optimizer, DEVICE, mask)
+                train(
+                    model,
+                    loader,
+                    method,
+                    criterion,
+                    optimizer,
+                    DEVICE,
+                    mask,
+                    gpu_transform,
+                )
 
                 if METHOD == "rl_split":
                     print("[MAIN] Fine tuning")
@@ -243,6 +269,7 @@ if __name__ == "__main__":
                         optimizer,
                         DEVICE,
                         mask,
+                        gpu_transform,
                     )
                 print(f"Learning rate: {optimizer.param_groups[0]['lr']}")
                 scheduler.step()
@@ -252,19 +279,25 @@ if __name__ == "__main__":
                 print("[MAIN] Evaluating model")
                 accs, losses = eval_unlearning(
                     model,
-                    [test_loader, forget_loader, retain_loader, val_loader],
-                    ["test", "forget", "retain", "val"],
+                    [test_loader, val_loader],
+                    ["test", "val"],
                     criterion,
                     DEVICE,
+                    gpu_transform=gpu_transform,
+                )
+                split_accs, split_losses = eval_train_split(
+                    model, train_loader, criterion, DEVICE, gpu_transform=gpu_transform
                 )
+                accs.update(split_accs)
+                losses.update(split_losses)
                 accs["forget"] = 1 - accs["forget"]
 
                 print("[MAIN] Computing MIA")
                 mia_auc, mia_acc = compute_basic_mia(
-                    torch.tensor(losses["retain"]),
-                    torch.tensor(losses["forget"]),
-                    torch.tensor(losses["val"]),
-                    torch.tensor(losses["test"]),
+                    losses["retain"],
+                    losses["forget"],
+                    losses["val"],
+                    losses["test"],
                 )
                 accs["mia_auc"] = mia_auc
                 accs["mia_acc"] = mia_acc
@@ -297,9 +330,12 @@ if __name__ == "__main__":
 
                 final_results = get_avg_std(all_results)
 
+                opt_meta, opt_blob = flatten_optimizer_state(optimizer.state_dict())
                 model_savefile = {
-                    "model": model.state_dict(),
-                    "optimizer": optimizer.state_dict(),
+                    # Unwrap torch.compile so checkpoint keys stay unprefixed
+                    "model": getattr(model, "_orig_mod", model).state_dict(),
+                    "opt_meta": opt_meta,
+                    "opt_blob": opt_blob,
                     "config": config,
                 }
 
@@ -2,15 +2,40 @@ import torch
 from tqdm import tqdm
 
 
+def get_forget_lut(ds, device):
+    # Cache the forget set as a boolean lookup table over dataset indices,
+    # built and moved to the device once instead of on every batch.
+    # Compare device types, not devices: "cuda" != "cuda:0" as a
+    # torch.device, which would rebuild the LUT on every call. The
+    # FORGET reference is kept so a reassigned forget set invalidates
+    # the cache instead of serving stale entries
+    forget_lut = getattr(ds, "_forget_lut", None)
+    if (
+        forget_lut is None
+        or forget_lut.device.type != torch.device(device).type
+        or getattr(ds, "_forget_lut_src", None) is not ds.FORGET
+    ):
+        forget_lut = torch.zeros(len(ds), dtype=torch.bool, device=device)
+        # Explicit long dtype: an empty FORGET would otherwise infer
+        # float and fail as an index
+        forget_lut[torch.tensor(ds.FORGET, dtype=torch.long, device=device)] = True
+        ds._forget_lut = forget_lut
+        ds._forget_lut_src = ds.FORGET
+    return forget_lut
+
+
 def rand_label(model, image, target, idx, criterion, loader, device):
     # Assign random labels to forget data
     ds = loader.dataset.dataset
-    forget_tensor = torch.tensor(ds.FORGET).to(device)
-    which_is_in = (idx.unsqueeze(1) == forget_tensor).any(dim=1)
-    # rand_targets = torch.randint(1, len(ds.classes), target.shape).to(device)
-    rand_targets = torch.randint(0, len(ds.classes), target.shape).to(device)
-    # rand_targets = (target + rand_targets) % len(ds.classes)
-    target[which_is_in] = rand_targets[which_is_in]
+    forget_lut = get_forget_lut(ds, device)
+    which_is_in = forget_lut[idx]
+    # Offset in [1, nclasses) guarantees a different label; the where
+    # fuses selection into a single elementwise kernel instead of a
+    # gather + indexed scatter
+    rand_offset = torch.randint(1, len(ds.classes), target.shape, device=device)
+    target = torch.where(
+        which_is_in, (target + rand_offset) % len(ds.classes), target
+    )
 
     output = model(image)
     loss = criterion(output, target)
@@ -23,8 +48,8 @@ def grad_ascent(model, image, target, idx, criterion, loader, device):
     loss = criterion(output, target)
 
     ds = loader.dataset.dataset
-    forget_tensor = torch.tensor(ds.FORGET).to(device)
-    which_is_in = (idx.unsqueeze(1) == forget_tensor).any(dim=1)
+    forget_lut = get_forget_lut(ds, device)
+    which_is_in = forget_lut[idx]
     loss[which_is_in] *= -1
     loss = loss.mean()
 
@@ -47,7 +72,14 @@ def retrain(model, image, target, idx, criterion, loader, device):
     return loss
 
 
-def compute_mask(model, forget_loader, unlearn_lr, saliency_threshold=0.5, device=None):
+def compute_mask(
+    model,
+    forget_loader,
+    unlearn_lr,
+    saliency_threshold=0.5,
+    device=None,
+    gpu_transform=None,
+):
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model.to(device)
@@ -67,10 +99,13 @@ def compute_mask(model, forget_loader, unlearn_lr, saliency_threshold=0.5, devic
         image = batch["image"].to(device)
         target = batch["label"].to(device)
 
+        if gpu_transform is not None:
+            image = gpu_transform(image)
+
         output = model(image)
         loss = -criterion(output, target)  # Negative loss for unlearning
 
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
 
         with torch.no_grad():
@@ -1,77 +1,149 @@
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import roc_auc_score
 import torch
 from tqdm import tqdm
 
+from methods import get_forget_lut
 from utils import compute_topk
 
 
 def compute_basic_mia(retain_losses, forget_losses, val_losses, test_losses):
-    train_loss = (
-        torch.cat((retain_losses, val_losses), dim=0).unsqueeze(1).cpu().numpy()
-    )
+    # The MIA feature is a single scalar (the loss), so the optimal
+    # decision boundary is a threshold: sweep it in closed form instead
+    # of fitting random forests every epoch
+    train_loss = torch.cat((retain_losses, val_losses), dim=0).float().cpu()
     train_target = torch.cat(
         (torch.ones(retain_losses.size(0)), torch.zeros(val_losses.size(0))), dim=0
-    ).numpy()
-    test_loss = (
-        torch.cat((forget_losses, test_losses), dim=0).unsqueeze(1).cpu().numpy()
     )
-    test_target = (
-        torch.cat((torch.ones(forget_losses.size(0)), torch.zeros(test_losses.size(0))))
-        .cpu()
-        .numpy()
+    test_loss = torch.cat((forget_losses, test_losses), dim=0).float().cpu()
+    test_target = torch.cat(
+        (torch.ones(forget_losses.size(0)), torch.zeros(test_losses.size(0))), dim=0
     )
 
-    best_auc = 0
-    best_acc = 0
-    for n_est in [20, 50, 100]:
-        for criterion in ["gini", "entropy"]:
-            mia_model = RandomForestClassifier(
-                n_estimators=n_est, criterion=criterion, n_jobs=8, random_state=0
+    # Members have lower loss, so the attack score is -loss; the AUC is
+    # the Mann-Whitney rank statistic of that score on the test split.
+    # Tied scores get their midrank, otherwise equal losses (common
+    # after unlearning) bias the statistic away from 0.5
+    n_pos = test_target.sum()
+    n_neg = test_target.size(0) - n_pos
+    scores = -test_loss
+    sorted_scores, order = torch.sort(scores)
+    counts = torch.unique_consecutive(sorted_scores, return_counts=True)[1]
+    ends = torch.cumsum(counts, dim=0)
+    group_mid = (ends - counts + ends + 1).float() / 2
+    ranks = torch.empty_like(scores)
+    ranks[order] = torch.repeat_interleave(group_mid, counts)
+    auc = (ranks[test_target == 1].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+    # Pick the threshold maximizing balanced accuracy on the train split,
+    # predicting member when loss <= threshold
+    sorted_loss, order = torch.sort(train_loss)
+    sorted_target = train_target[order]
+    pos_below = torch.cumsum(sorted_target, dim=0)
+    n_train_pos = sorted_target.sum()
+    n_train_neg = sorted_target.size(0) - n_train_pos
+    all_below = torch.arange(1, sorted_target.size(0) + 1)
+    balanced_acc = (
+        pos_below / n_train_pos + (n_train_neg - (all_below - pos_below)) / n_train_neg
+    ) / 2
+    threshold = sorted_loss[torch.argmax(balanced_acc)]
+
+    # Fraction of forget samples classified as non-members
+    y_hat = (forget_losses.float().cpu() <= threshold).float().mean().item()
+    acc = (1 - y_hat) * 100
+
+    return auc.item() * 100, acc
+
+
+def eval_train_split(model, loader, criterion, DEVICE, gpu_transform=None):
+    # The train loader covers exactly FORGET + RETAIN, so a single pass
+    # split per-sample by the forget LUT replaces two separate evals
+    ds = loader.dataset.dataset
+    forget_lut = get_forget_lut(ds, DEVICE)
+
+    with torch.inference_mode():
+        model.eval()
+
+        loss_buf = []
+        mask_buf = []
+        forget_correct = torch.zeros((), device=DEVICE)
+        retain_correct = torch.zeros((), device=DEVICE)
+        for data in tqdm(loader):
+
+            image = data["image"]
+            target = data["label"]
+            idx = data["idx"]
+            image = image.to(
+                DEVICE, non_blocking=True, memory_format=torch.channels_last
             )
-            mia_model.fit(train_loss, train_target)
+            target = target.to(DEVICE, non_blocking=True)
+            idx = idx.to(DEVICE, non_blocking=True)
 
-            y_hat = mia_model.predict_proba(test_loss)[:, 1]
-            auc = roc_auc_score(test_target, y_hat) * 100
-            # breakpoint()
-            y_hat = mia_model.predict(forget_losses.unsqueeze(1).cpu().numpy()).mean()
+            if gpu_transform is not None:
+                image = gpu_transform(image)
 
-            # breakpoint()
-            acc = (1 - y_hat) * 100
+            with torch.autocast("cuda", dtype=torch.bfloat16, enabled=DEVICE == "cuda"):
+                output = model(image)
+                loss = criterion(output, target)
 
-            if acc > best_acc:
-                best_acc = acc
-                best_auc = auc
-    # breakpoint()
-    return best_auc, best_acc
+            is_forget = forget_lut[idx]
+            correct = output.argmax(dim=1) == target
+            forget_correct += (correct & is_forget).sum()
+            retain_correct += (correct & ~is_forget).sum()
+
+            loss_buf.append(loss.detach())
+            mask_buf.append(is_forget)
+
+        loss_all = torch.cat(loss_buf)
+        mask_all = torch.cat(mask_buf)
+
+        accs = {
+            "forget": (forget_correct / max(len(ds.FORGET), 1)).item(),
+            "retain": (retain_correct / max(len(ds.RETAIN), 1)).item(),
+        }
+        losses = {
+            "forget": loss_all[mask_all].cpu(),
+            "retain": loss_all[~mask_all].cpu(),
+        }
+    return accs, losses
 
 
-def eval_unlearning(model, loaders, names, criterion, DEVICE):
+def eval_unlearning(model, loaders, names, criterion, DEVICE, gpu_transform=None):
 
-    with torch.no_grad():
+    with torch.inference_mode():
         model.eval()
-        tot_acc = 0
         accs = {}
         losses = {}
         for loader, name in zip(loaders, names):
 
-            losses[name] = []
+            # Reset per loader: the old shared accumulator leaked the
+            # previous loaders' (already normalized) counts into accs
+            tot_acc = torch.zeros((), device=DEVICE)
+            loss_buf = []
             for data in tqdm(loader):
 
                 image = data["image"]
                 target = data["label"]
-                image = image.to(DEVICE, non_blocking=True)
+                image = image.to(
+                    DEVICE, non_blocking=True, memory_format=torch.channels_last
+                )
                 target = target.to(DEVICE, non_blocking=True)
 
-                output = model(image)
-                loss = criterion(output, target)
+                if gpu_transform is not None:
+                    image = gpu_transform(image)
+
+                with torch.autocast(
+                    "cuda", dtype=torch.bfloat16, enabled=DEVICE == "cuda"
+                ):
+                    output = model(image)
+                    loss = criterion(output, target)
 
-                losses[name].append(loss.mean().item())
+                loss_buf.append(loss.detach())
 
                 acc = compute_topk(target, output, 1)
 
                 tot_acc += acc
 
-            tot_acc /= len(loader.dataset)
-            accs[name] = tot_acc
+            accs[name] = (tot_acc / len(loader.dataset)).item()
+            # Per-sample losses (criterion uses reduction="none"), moved to
+            # CPU with a single transfer per loader
+            losses[name] = torch.cat(loss_buf).cpu()
     return accs, losses
@@ -2,7 +2,6 @@ import datetime
 import json
 import os
 import torch
-import numpy as np
 import wandb
 import argparse
 
@@ -11,66 +10,90 @@ from tqdm import tqdm
 from dotenv import load_dotenv
 
 from datasets import get_dataloaders
-from utils import get_model, compute_topk, load_checkpoint
+from utils import (
+    get_model,
+    compute_topk_multi,
+    load_checkpoint,
+    flatten_optimizer_state,
+    CUDAPrefetcher,
+    split_gpu_transform,
+)
 
 
-def train_loop(model, train_loader, criterion, optimizer, device):
+def train_loop(model, train_loader, criterion, optimizer, device, gpu_transform=None):
 
     model.train()
 
     losses = []
 
-    for _, data in enumerate(tqdm(train_loader)):
+    for _, data in enumerate(tqdm(CUDAPrefetcher(train_loader, device))):
 
         image = data["image"]
         label = data["label"]
 
-        image = image.to(device)
-        label = label.to(device)
+        image = image.to(
+            device, non_blocking=True, memory_format=torch.channels_last
+        )
+        label = label.to(device, non_blocking=True)
+
+        if gpu_transform is not None:
+            image = gpu_transform(image)
 
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
 
-        output = model(image)
+        with torch.autocast("cuda", dtype=torch.bfloat16, enabled=device == "cuda"):
+            output = model(image)
 
-        loss = criterion(output, label)
+            loss = criterion(output, label)
 
-        losses.append(loss.item())
+        losses.append(loss.detach())
 
         loss.backward()
         optimizer.step()
 
-    return np.mean(losses)
+    # Single sync at the end instead of one .item() per batch
+    return torch.stack(losses).mean().item()
 
 
-def test_loop(model, loader, criterion, device):
+def test_loop(model, loader, criterion, device, gpu_transform=None):
 
     model.eval()
 
     losses = []
-    top1 = 0
-    top5 = 0
-    for idx, data in enumerate(tqdm(loader)):
+    top1 = torch.zeros((), device=device)
+    top5 = torch.zeros((), device=device)
+    for idx, data in enumerate(tqdm(CUDAPrefetcher(loader, device))):
 
         image = data["image"]
         labels = data["label"]
 
-        image = image.to(device, non_blocking=True)
+        image = image.to(
+            device, non_blocking=True, memory_format=torch.channels_last
+        )
         labels = labels.to(device, non_blocking=True)
 
-        with torch.no_grad():
+        if gpu_transform is not None:
+            image = gpu_transform(image)
 
-            output = model(image)
-            loss = criterion(output, labels)
+        with torch.inference_mode():
 
-            losses.append(loss.item())
+            with torch.autocast(
+                "cuda", dtype=torch.bfloat16, enabled=device == "cuda"
+            ):
+                output = model(image)
+                loss = criterion(output, labels)
 
-            top1 += compute_topk(labels, output, 1)
-            top5 += compute_topk(labels, output, 5)
+            losses.append(loss.detach())
 
-    top1_acc = top1 / len(loader.dataset)
-    top5_acc = top5 / len(loader.dataset)
+            topk = compute_topk_multi(labels, output, (1, 5))
+            top1 += topk[1]
+            top5 += topk[5]
 
-    return np.mean(losses), top1_acc, top5_acc
+    # One sync per metric at the end of the loader
+    top1_acc = (top1 / len(loader.dataset)).item()
+    top5_acc = (top5 / len(loader.dataset)).item()
+
+    return torch.stack(losses).mean().item(), top1_acc, top5_acc
 
 
 def get_args():
@@ -126,6 +149,8 @@ if __name__ == "__main__":
     nclasses = 100 if DSET == "cifar100" else 10
 
     model, config, transform = get_model(MODEL, nclasses, True)
+    # Normalization runs batched on the GPU, workers only decode+resize
+    transform, gpu_transform = split_gpu_transform(transform)
 
     (
         train_loader,
@@ -148,7 +173,9 @@ if __name__ == "__main__":
         "nclasses": nclasses,
     }
 
-    model = model.to(DEVICE)
+    model = model.to(DEVICE, memory_format=torch.channels_last)
+    if DEVICE == "cuda":
+        model = torch.compile(model, mode="reduce-overhead")
 
     optimizer = torch.optim.SGD(
         model.parameters(), lr=LR, momentum=0.9, weight_decay=5e-4
@@ -167,13 +194,17 @@ if __name__ == "__main__":
     pat = PAT
     for epoch in range(EPOCHS):
 
-        loss = train_loop(model, retain_loader, criterion, optimizer, DEVICE)
+        loss = train_loop(
+            model, retain_loader, criterion, optimizer, DEVICE, gpu_transform
+        )
 
-        val_loss, val_top1, val_top5 = test_loop(model, val_loader, criterion, DEVICE)
+        val_loss, val_top1, val_top5 = test_loop(
+            model, val_loader, criterion, DEVICE, gpu_transform
+        )
 
         if len(forget_loader) > 0:
             for_loss, for_top1, for_top5 = test_loop(
-                model, forget_loader, criterion, DEVICE
+                model, forget_loader, criterion, DEVICE, gpu_transform
             )
 
         scheduler.step(val_top1)
@@ -193,9 +224,12 @@ if __name__ == "__main__":
             best_acc = val_top1
             pat = PAT
 
+            opt_meta, opt_blob = flatten_optimizer_state(optimizer.state_dict())
             model_savefile = {
-                "model": model.state_dict(),
-                "optimizer": optimizer.state_dict(),
+                # Unwrap torch.compile so checkpoint keys stay unprefixed
+                "model": getattr(model, "_orig_mod", model).state_dict(),
+                "opt_meta": opt_meta,
+                "opt_blob": opt_blob,
                 "config": config,
             }
 
@@ -207,7 +241,9 @@ if __name__ == "__main__":
             if pat == 0:
                 break
 
-    test_loss, test_top1, test_top5 = test_loop(model, test_loader, criterion, DEVICE)
+    test_loss, test_top1, test_top5 = test_loop(
+        model, test_loader, criterion, DEVICE, gpu_transform
+    )
 
     print(
         f"Test Loss: {round(test_loss,3)}, Test Top1: {round(test_top1,3)} Test Top5: {round(test_top5,3)}"